@@ -1,9 +1,13 @@
 import asyncio
+import json
+from collections.abc import Iterator
 from pathlib import Path
 import time
 import os
-import requests
+import shutil
 import tempfile
+import threading
+import httpx
 import streamlit as st
 import inngest
 from dotenv import load_dotenv
@@ -33,41 +37,137 @@ def _inngest_api_base() -> str:
     return os.getenv("INNGEST_API_BASE", "http://127.0.0.1:8288/v1")
 
 
+# One pooled client for all polls, kept across reruns, so each request reuses
+# a kept-alive connection instead of paying for a new TCP handshake. The
+# cached client is shared by every session, hence the pool size.
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+        timeout=5.0,
+    )
+
+
 def fetch_runs(event_id: str) -> list[dict]:
     url = f"{_inngest_api_base()}/events/{event_id}/runs"
-    resp = requests.get(url)
+    resp = get_http_client().get(url)
     resp.raise_for_status()
     return resp.json().get("data", [])
 
 
-def wait_for_run_output(event_id: str, timeout_s: float = 120.0) -> dict:
+_DONE_STATUSES = ("Completed", "Succeeded", "Success", "Finished")
+_FAILED_STATUSES = ("Failed", "Cancelled")
+
+
+def _run_result(run: dict) -> dict | None:
+    status = run.get("status")
+    if status in _DONE_STATUSES:
+        return run.get("output") or {}
+    if status in _FAILED_STATUSES:
+        return {
+            "answer": "An internal error occurred. Please try again.",
+            "sources": [],
+            "roles": [],
+        }
+    return None
+
+
+def _timeout_result() -> dict:
+    return {
+        "answer": "Timed out waiting for response. Please try again.",
+        "sources": [],
+        "roles": [],
+    }
+
+
+def _use_run_stream() -> bool:
+    return os.getenv("INNGEST_RUN_STREAM", "").lower() in ("1", "true", "yes")
+
+
+def wait_for_run_output(
+    event_id: str,
+    timeout_s: float = 120.0,
+    initial_delay: float = 0.05,
+    max_delay: float = 2.0,
+    backoff: float = 1.3,
+) -> dict:
+    if _use_run_stream():
+        return wait_for_run_output_stream(event_id, timeout_s)
+
     start = time.time()
+    delay = initial_delay
     while True:
         runs = fetch_runs(event_id)
         if runs:
-            run = runs[0]
-            status = run.get("status")
-            if status in ("Completed", "Succeeded", "Success", "Finished"):
-                return run.get("output") or {}
-            if status in ("Failed", "Cancelled"):
-                return {
-                    "answer": "An internal error occurred. Please try again.",
-                    "sources": [],
-                    "roles": [],
-                }
+            result = _run_result(runs[0])
+            if result is not None:
+                return result
         if time.time() - start > timeout_s:
-            return {
-                "answer": "Timed out waiting for response. Please try again.",
-                "sources": [],
-                "roles": [],
-            }
-        time.sleep(0.4)
+            return _timeout_result()
+        # Poll densely at first to catch fast runs, then back off for long ones.
+        time.sleep(delay)
+        delay = min(delay * backoff, max_delay)
+
+
+def _iter_run_frames(resp: httpx.Response) -> Iterator[dict]:
+    for line in resp.iter_lines():
+        line = line.strip()
+        if line.startswith("data:"):
+            line = line[len("data:"):].strip()
+        if not line or line.startswith(":"):
+            continue
+        try:
+            frame = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(frame, dict):
+            continue
+        # Frames are either bare runs or the same {"data": [...]} envelope
+        # the polling endpoint returns.
+        if isinstance(frame.get("data"), list):
+            yield from frame["data"]
+        else:
+            yield frame
+
+
+# Long-poll/SSE variant: the server holds the request open and pushes the run
+# once it finishes. Opt in with INNGEST_RUN_STREAM=1 on backends that honour
+# ``?wait=``; everything else keeps using the polling path above.
+def wait_for_run_output_stream(event_id: str, timeout_s: float = 120.0, wait_s: float = 30.0) -> dict:
+    url = f"{_inngest_api_base()}/events/{event_id}/runs"
+    start = time.time()
+    while (remaining := timeout_s - (time.time() - start)) > 0:
+        wait = min(wait_s, remaining)
+        opened = time.time()
+        with get_http_client().stream(
+            "GET",
+            url,
+            params={"wait": str(max(1, int(wait)))},
+            headers={"Accept": "text/event-stream, application/x-ndjson"},
+            timeout=httpx.Timeout(5.0, read=wait + 5.0),
+        ) as resp:
+            resp.raise_for_status()
+            for run in _iter_run_frames(resp):
+                result = _run_result(run)
+                if result is not None:
+                    return result
+        # A backend that ignores ``wait`` answers immediately; don't spin on it.
+        if time.time() - opened < 1.0:
+            time.sleep(0.5)
+    return _timeout_result()
 
 
 def wait_for_document(source_id: str, timeout_s: float = 5.0, poll_interval: float = 0.5) -> list[dict] | None:
     start = time.time()
     while time.time() - start < timeout_s:
-        docs = list_documents()
+        # Poll through the shared cache so the list that finally contains the
+        # new document is the one later reruns (and other sessions) reuse.
+        get_documents_cached.clear()
+        try:
+            docs = get_documents_cached()
+        except RuntimeError:
+            docs = []
         if any(d["source_id"] == source_id for d in docs):
             return docs
         time.sleep(poll_interval)
@@ -78,25 +178,51 @@ def wait_for_document(source_id: str, timeout_s: float = 5.0, poll_interval: flo
 # Backend calls
 # -------------------------------------------------
 
-async def send_event(name: str, data: dict) -> str:
-    client = get_inngest_client()
+# A long-lived loop on a daemon thread, shared by every session, so the
+# Inngest client's HTTP connections survive across reruns instead of being
+# torn down with a fresh asyncio.run() loop each time.
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+async def send_event(client: inngest.Inngest, name: str, data: dict) -> str:
     event_ids = await client.send(inngest.Event(name=name, data=data))
     return event_ids[0]
 
 
+def send_event_sync(name: str, data: dict) -> str:
+    # Resolve the cached client here, on the script thread; the loop thread
+    # has no Streamlit script context for cache_resource to use.
+    client = get_inngest_client()
+    future = asyncio.run_coroutine_threadsafe(send_event(client, name, data), get_event_loop())
+    return future.result()
+
+
 def list_documents() -> list[dict]:
-    event_id = asyncio.run(send_event("rag/list_documents", {}))
+    event_id = send_event_sync("rag/list_documents", {})
     output = wait_for_run_output(event_id)
-    return output.get("documents", [])
+    # Failed or timed-out runs come back without "documents"; raise rather
+    # than let an empty list be cached and wipe every session's selection.
+    if "documents" not in output:
+        raise RuntimeError(output.get("answer", "Listing documents failed."))
+    return output["documents"]
 
 
 def delete_document(source_id: str):
-    event_id = asyncio.run(
-        send_event("rag/delete_document", {"source_id": source_id})
-    )
+    event_id = send_event_sync("rag/delete_document", {"source_id": source_id})
     wait_for_run_output(event_id)
 
 
+# Shared across sessions; cleared explicitly whenever a document is added or
+# removed, the TTL only catches changes made outside this app.
+@st.cache_data(ttl=60, show_spinner=False)
+def get_documents_cached() -> list[dict]:
+    return list_documents()
+
+
 # -------------------------------------------------
 # Sidebar – document management
 # -------------------------------------------------
@@ -110,11 +236,8 @@ uploaded = st.sidebar.file_uploader(
     accept_multiple_files=False,
 )
 
-if "needs_refresh" not in st.session_state:
-    st.session_state.needs_refresh = True
-
 if st.sidebar.button("Refresh documents"):
-    st.session_state.needs_refresh = True
+    get_documents_cached.clear()
     st.rerun()
 
 if uploaded is not None:
@@ -124,19 +247,19 @@ if uploaded is not None:
 
             with tempfile.TemporaryDirectory() as tmpdir:
                 pdf_path = Path(tmpdir) / original_filename
-                pdf_path.write_bytes(uploaded.getbuffer())
-
-                event_id = asyncio.run(
-                    send_event(
-                        "rag/ingest_pdf",
-                        {
-                            "pdf_path": str(pdf_path.resolve()),
-                            "original_filename": original_filename,
-                            "policy_type": "policy_type",
-                            "version": "version",
-                            "jurisdiction": "jurisdiction",
-                        },
-                    )
+                uploaded.seek(0)
+                with open(pdf_path, "wb") as out:
+                    shutil.copyfileobj(uploaded, out, length=1 << 20)
+
+                event_id = send_event_sync(
+                    "rag/ingest_pdf",
+                    {
+                        "pdf_path": str(pdf_path.resolve()),
+                        "original_filename": original_filename,
+                        "policy_type": "policy_type",
+                        "version": "version",
+                        "jurisdiction": "jurisdiction",
+                    },
                 )
 
                 output = wait_for_run_output(event_id)
@@ -154,15 +277,13 @@ if uploaded is not None:
             st.stop()
 
         st.success("Document ingested")
-        st.session_state.docs = docs
-        st.session_state.needs_refresh = False
         st.rerun()
 
-if st.session_state.needs_refresh or not isinstance(st.session_state.get("docs"), list):
-    st.session_state.docs = list_documents()
-    st.session_state.needs_refresh = False
-
-docs = st.session_state.docs
+try:
+    docs = get_documents_cached()
+except RuntimeError:
+    st.sidebar.error("Could not load documents. Please refresh to try again.")
+    st.stop()
 
 current_ids = {d["source_id"] for d in docs}
 
@@ -200,7 +321,7 @@ for doc in docs:
     if st.sidebar.button("Delete", key=f"del_{sid}"):
         delete_document(sid)
         st.session_state.selected_docs.discard(sid)
-        st.session_state.needs_refresh = True
+        get_documents_cached.clear()
         st.rerun()
 
 st.sidebar.caption("Unchecked documents are excluded from search.")
@@ -223,14 +344,12 @@ if not st.session_state.selected_docs:
 
 if submitted and question.strip():
     with st.spinner("Searching policies..."):
-        event_id = asyncio.run(
-            send_event(
-                "rag/query_pdf_ai",
-                {
-                    "question": question.strip(),
-                    "allowed_sources": list(st.session_state.selected_docs),
-                },
-            )
+        event_id = send_event_sync(
+            "rag/query_pdf_ai",
+            {
+                "question": question.strip(),
+                "allowed_sources": list(st.session_state.selected_docs),
+            },
         )
 
         output = wait_for_run_output(event_id)
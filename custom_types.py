@@ -1,11 +1,6 @@
 import pydantic
 
 
-class RAGChunkAndSrc(pydantic.BaseModel):
-    chunks: list[str]
-    source_id: str = None
-
-
 class RAGUpsertResult(pydantic.BaseModel):
     ingested: int
 
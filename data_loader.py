@@ -1,14 +1,24 @@
-from openai import OpenAI
+import asyncio
+import functools
+import hashlib
+from collections import OrderedDict
+from collections.abc import Iterator
+import tiktoken
+from openai import AsyncOpenAI
 from llama_index.readers.file import PDFReader
 from llama_index.core.node_parser import SentenceSplitter
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = OpenAI()
+client = AsyncOpenAI()
 
 EMBED_MODEL = "text-embedding-3-large"
-EMBED_DIM = 3072
+EMBED_DIM = 1024
+EMBED_BATCH_SIZE = 96
+EMBED_BATCH_TOKENS = 8192
+EMBED_CONCURRENCY = 8
+QUERY_CACHE_SIZE = 1024
 
 splitter = SentenceSplitter(chunk_size=1000, chunk_overlap=200)
 # splitter = SentenceSplitter(chunk_size=700, chunk_overlap=150)
@@ -31,18 +41,84 @@ def extract_roles(text: str) -> list[str]:
     return [r for r in ROLE_PATTERNS if r in text]
 
 
-def load_and_chunk_pdf(path: str):
-    docs = PDFReader().load_data(file=path)
-    texts = [d.text for d in docs if getattr(d, "text", None)]
-    chunks = []
-    for t in texts:
-        chunks.extend(splitter.split_text(t))
-    return chunks
+def iter_chunks(path: str) -> Iterator[str]:
+    for doc in PDFReader().load_data(file=path):
+        text = getattr(doc, "text", None)
+        if text:
+            yield from splitter.split_text(text)
 
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
-    response = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=texts,
-    )
-    return [item.embedding for item in response.data]
+def chunk_hash(text: str) -> str:
+    # Stored vectors are reused by hash, so the embedding model and size are
+    # part of it: changing either must not pick up vectors from another space.
+    key = f"{EMBED_MODEL}:{EMBED_DIM}:{text}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(EMBED_MODEL)
+
+
+def _token_batches(texts: list[str]) -> list[list[str]]:
+    enc = _encoding()
+    batches = []
+    batch, tokens = [], 0
+    for text in texts:
+        n = len(enc.encode(text, disallowed_special=()))
+        if batch and (len(batch) >= EMBED_BATCH_SIZE or tokens + n > EMBED_BATCH_TOKENS):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(text)
+        tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Shared by every embed_texts_async call in the process, so concurrent
+# callers (e.g. the ingest pipeline's batches) stay within one limit.
+_embed_semaphore: asyncio.Semaphore | None = None
+
+
+def _get_embed_semaphore() -> asyncio.Semaphore:
+    global _embed_semaphore
+    if _embed_semaphore is None:
+        _embed_semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    return _embed_semaphore
+
+
+async def embed_texts_async(texts: list[str]) -> list[list[float]]:
+    if not texts:
+        return []
+
+    sem = _get_embed_semaphore()
+
+    async def _embed(batch: list[str]) -> list[list[float]]:
+        async with sem:
+            response = await client.embeddings.create(
+                model=EMBED_MODEL,
+                input=batch,
+                dimensions=EMBED_DIM,
+            )
+        return [item.embedding for item in response.data]
+
+    results = await asyncio.gather(*(_embed(b) for b in _token_batches(texts)))
+    return [vec for batch in results for vec in batch]
+
+
+# Embeddings are deterministic per model, so repeated questions can skip the
+# OpenAI round-trip entirely. Entries never go stale; the size cap bounds RAM.
+_query_cache: OrderedDict[str, tuple[float, ...]] = OrderedDict()
+
+
+async def embed_query(text: str) -> list[float]:
+    vec = _query_cache.get(text)
+    if vec is None:
+        vec = tuple((await embed_texts_async([text]))[0])
+        _query_cache[text] = vec
+        if len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    else:
+        _query_cache.move_to_end(text)
+    return list(vec)
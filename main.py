@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from fastapi import FastAPI
 import inngest
@@ -7,11 +8,13 @@ from dotenv import load_dotenv
 import uuid
 import os
 from datetime import datetime
-from custom_types import RAGQueryResult, RAGSearchResult, RAGChunkAndSrc, RAGUpsertResult
-from data_loader import load_and_chunk_pdf, embed_texts, extract_roles
-from vector_db import QdrantStorage
+from itertools import islice
+from custom_types import RAGQueryResult, RAGSearchResult, RAGUpsertResult
+from data_loader import EMBED_BATCH_SIZE, iter_chunks, chunk_hash, embed_texts_async, embed_query, extract_roles
+from vector_db import get_async_storage, get_storage
 
 MAX_CONTEXT_CHARS = 3500
+MAX_INFLIGHT_BATCHES = 4
 
 load_dotenv()
 
@@ -28,37 +31,78 @@ inngest_client = inngest.Inngest(
     trigger=inngest.TriggerEvent(event="rag/ingest_pdf")
 )
 async def rag_ingest_pdf(ctx: inngest.Context):
-    def _load(ctx: inngest.Context) -> RAGChunkAndSrc:
-        pdf_path = ctx.event.data["pdf_path"]
+    policy_type = ctx.event.data.get("policy_type", "")
+    version = ctx.event.data.get("version", "")
+    jurisdiction = ctx.event.data.get("jurisdiction", "")
+
+    def _source_id(ctx: inngest.Context) -> str:
         filename = ctx.event.data.get("original_filename", "unknown.pdf")
         timestamp = datetime.utcnow().isoformat(timespec="seconds")
-        source_id = f"{filename}::{timestamp}"
-        chunks = load_and_chunk_pdf(pdf_path)
-        return RAGChunkAndSrc(chunks=chunks, source_id=source_id)
-
-    def _upsert(chunks_and_src: RAGChunkAndSrc) -> RAGUpsertResult:
-        chunks = chunks_and_src.chunks
-        source_id = chunks_and_src.source_id
-        vecs = embed_texts(chunks)
-        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(len(chunks))]
+        return f"{filename}::{timestamp}"
+
+    async def _embed_batch(store, source_id: str, offset: int, chunks: list[str]) -> tuple[list[str], list, list[dict]]:
+        # Reuse vectors already stored for identical chunk text (re-ingests,
+        # shared boilerplate) and only send the new text to OpenAI.
+        hashes = [chunk_hash(c) for c in chunks]
+        known = await asyncio.to_thread(store.vectors_by_chunk_hash, list(set(hashes)))
+        missing = {h: c for h, c in zip(hashes, chunks) if h not in known}
+        if missing:
+            new_vecs = await embed_texts_async(list(missing.values()))
+            known.update(zip(missing.keys(), new_vecs))
+        vecs = [known[h] for h in hashes]
+        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(offset, offset + len(chunks))]
         payloads = [{
             "source": source_id,
-            "text": chunks[i],
-            "policy_type": ctx.event.data.get("policy_type", ""),
-            "version": ctx.event.data.get("version", ""),
-            "jurisdiction": ctx.event.data.get("jurisdiction", ""),
+            "text": chunk,
+            "policy_type": policy_type,
+            "version": version,
+            "jurisdiction": jurisdiction,
             "section": "",
-            "roles": extract_roles(chunks[i]),
-        } for i in range(len(chunks))]
-
-        QdrantStorage().upsert(ids, vecs, payloads)
-        return RAGUpsertResult(ingested=len(chunks))
-
-    chunks_and_src = await ctx.step.run("load-and-chunk", lambda: _load(ctx), output_type=RAGChunkAndSrc)
-    ingested = await ctx.step.run("embed-and-upsert", lambda: _upsert(chunks_and_src), output_type=RAGUpsertResult)
+            "roles": extract_roles(chunk),
+            "chunk_hash": h,
+        } for chunk, h in zip(chunks, hashes)]
+        return ids, vecs, payloads
+
+    async def _ingest(source_id: str) -> RAGUpsertResult:
+        # Three overlapping stages: the PDF is chunked in a worker thread while
+        # earlier batches are embedded, and embedded batches are upserted
+        # while later ones are still at OpenAI. A batch's embedding only
+        # starts once a slot is free, so at most MAX_INFLIGHT_BATCHES batches
+        # are being embedded or waiting to be upserted.
+        chunk_iter = iter_chunks(ctx.event.data["pdf_path"])
+        # First use runs blocking collection setup RPCs; keep them off the loop.
+        store = await asyncio.to_thread(get_storage)
+        slots = asyncio.Semaphore(MAX_INFLIGHT_BATCHES)
+        embedded: asyncio.Queue[asyncio.Task | None] = asyncio.Queue()
+
+        async with asyncio.TaskGroup() as tg:
+            async def _produce() -> None:
+                offset = 0
+                while chunks := await asyncio.to_thread(lambda: list(islice(chunk_iter, EMBED_BATCH_SIZE))):
+                    await slots.acquire()
+                    embedded.put_nowait(tg.create_task(_embed_batch(store, source_id, offset, chunks)))
+                    offset += len(chunks)
+                embedded.put_nowait(None)
+
+            async def _consume() -> int:
+                ingested = 0
+                while (task := await embedded.get()) is not None:
+                    ids, vecs, payloads = await task
+                    await asyncio.to_thread(store.upsert, ids, vecs, payloads)
+                    slots.release()
+                    ingested += len(ids)
+                return ingested
+
+            tg.create_task(_produce())
+            consumer = tg.create_task(_consume())
+
+        return RAGUpsertResult(ingested=consumer.result())
+
+    source_id = await ctx.step.run("create-source-id", lambda: _source_id(ctx))
+    ingested = await ctx.step.run("chunk-embed-and-upsert", lambda: _ingest(source_id), output_type=RAGUpsertResult)
     return {
         **ingested.model_dump(),
-        "source_id": chunks_and_src.source_id,
+        "source_id": source_id,
     }
 
 
@@ -67,20 +111,25 @@ async def rag_ingest_pdf(ctx: inngest.Context):
     trigger=inngest.TriggerEvent(event="rag/query_pdf_ai")
 )
 async def rag_query_pdf_ai(ctx: inngest.Context):
-    def _search(question: str, top_k: int = 5, allowed_sources: list[str] | None = None, ) -> RAGSearchResult:
-        query_vec = embed_texts([question])[0]
-        store = QdrantStorage()
-        found = store.search(query_vec, top_k, allowed_sources=allowed_sources)
+    async def _search(question: str, top_k: int = 5, allowed_sources: list[str] | None = None, ) -> RAGSearchResult:
+        query_vec = await embed_query(question)
+        store = await get_async_storage()
+        found = await store.search(query_vec, top_k, allowed_sources=allowed_sources)
         return RAGSearchResult(contexts=found["contexts"], sources=found["sources"], roles=found["roles"])
 
     def select_context_chunks(chunks):
+        # Chunks arrive most-relevant first. A chunk that doesn't fit is
+        # skipped so smaller, less relevant ones can still fill the budget;
+        # we only stop once the remaining room is too small to be useful.
         total = 0
         selected = []
         for c in chunks:
-            if total + len(c) > MAX_CONTEXT_CHARS:
+            size = len(c)
+            if total + size <= MAX_CONTEXT_CHARS:
+                selected.append(c)
+                total += size
+            elif MAX_CONTEXT_CHARS - total < MAX_CONTEXT_CHARS // 4:
                 break
-            selected.append(c)
-            total += len(c)
         return selected
 
     question = ctx.event.data["question"]
@@ -152,7 +201,9 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
     trigger=inngest.TriggerEvent(event="rag/list_documents")
 )
 async def rag_list_documents(ctx: inngest.Context):
-    docs = QdrantStorage().list_documents()
+    # Sync Qdrant calls go to a thread so concurrent queries keep running.
+    store = await asyncio.to_thread(get_storage)
+    docs = await asyncio.to_thread(store.list_documents)
     return {"documents": docs}
 
 
@@ -163,8 +214,8 @@ async def rag_list_documents(ctx: inngest.Context):
 async def rag_delete_document(ctx: inngest.Context):
     source_id = ctx.event.data["source_id"]
 
-    store = QdrantStorage()
-    deleted = store.delete_document(source_id)
+    store = await asyncio.to_thread(get_storage)
+    deleted = await asyncio.to_thread(store.delete_document, source_id)
 
     return {
         "source_id": source_id,
@@ -1,164 +1,511 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct, Filter, FieldCondition, MatchValue, MatchAny
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from collections.abc import Iterator
+import os
+import grpc
+import numpy as np
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.models import (
+    VectorParams, Distance, Batch, Filter, FieldCondition, MatchValue, MatchAny,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, SearchParams, QuantizationSearchParams,
+    PayloadSchemaType, QueryRequest, FilterSelector, HnswConfigDiff, ScoredPoint,
+)
+
+UPSERT_BATCH_SIZE = 256
+# source: allowed_sources in search, delete_document, the list_documents
+# facet. chunk_hash: the embedding reuse lookup at ingest.
+INDEXED_FIELDS = ("source", "chunk_hash")
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 300.0
+
+
+# One client (and so one HTTP pool / gRPC channel) per server, shared by every
+# QdrantStorage in the process. QdrantClient is safe to use across threads.
+@functools.lru_cache(maxsize=None)
+def _shared_client(url: str, prefer_grpc: bool, grpc_port: int) -> QdrantClient:
+    # gRPC sends vectors as packed floats instead of JSON text.
+    return QdrantClient(url=url, prefer_grpc=prefer_grpc, grpc_port=grpc_port, timeout=30)
+
+
+# The same selection of documents is usually searched many times in a row;
+# sorting the key makes the cache hit regardless of the order it arrives in.
+@functools.lru_cache(maxsize=256)
+def _build_source_filter(sources: tuple[str, ...]) -> Filter:
+    return Filter(
+        must=[
+            FieldCondition(
+                key="source",
+                match=MatchAny(any=list(sources))
+            )
+        ]
+    )
+
+
+def _copy_result(result: dict) -> dict:
+    return {
+        "contexts": list(result["contexts"]),
+        "sources": [dict(s) for s in result["sources"]],
+        "roles": list(result["roles"]),
+    }
+
+
+# Search results keyed on the exact query. Writes through QdrantStorage clear
+# it; the TTL bounds staleness from writes made by other processes.
+class _SearchCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every clear(). A search captures it before querying so a
+        # result read before a write can't be stored after that write.
+        self.generation = 0
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, result = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return _copy_result(result)
+
+    def put(self, key: tuple, result: dict, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic(), _copy_result(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+
+_search_cache = _SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+
+def _facet_unsupported(e: Exception) -> bool:
+    if isinstance(e, UnexpectedResponse):
+        return e.status_code == 404
+    return isinstance(e, grpc.RpcError) and e.code() == grpc.StatusCode.UNIMPLEMENTED
+
+
+def _empty_result() -> dict:
+    return {
+        "contexts": [],
+        "sources": [],
+        "roles": [],
+    }
+
+
+def _collect_results(points: list[ScoredPoint], min_score: float) -> dict:
+    # Missing scores become NaN, which fails the comparison like a low score.
+    scores = np.fromiter(
+        (np.nan if p.score is None else p.score for p in points),
+        dtype=np.float32,
+        count=len(points),
+    )
+    keep = np.flatnonzero(scores >= min_score)
+
+    contexts: list[str] = []
+    sources: dict[tuple[str, str, str], dict[str, str]] = {}
+    roles: set[str] = set()
+
+    for idx in keep:
+        get = (points[idx].payload or {}).get
+        text = get("text", "")
+        if not text:
+            continue
+
+        contexts.append(text)
+        source = get("source")
+        if source:
+            # Dedupe on (document, section, version) as we go instead of
+            # building a list and collapsing it afterwards. The remaining
+            # fields are only read for the first hit of each key.
+            section = get("section", "")
+            version = get("version", "")
+            key = (source, section, version)
+            if key not in sources:
+                sources[key] = {
+                    "document": source,
+                    "section": section,
+                    "policy_type": get("policy_type", ""),
+                    "version": version,
+                    "jurisdiction": get("jurisdiction", ""),
+                }
+        roles.update(get("roles") or ())
+
+    if not contexts:
+        return _empty_result()
+
+    return {
+        "contexts": contexts,
+        "sources": list(sources.values()),
+        "roles": sorted(roles),
+    }
 
 
 class QdrantStorage:
-    def __init__(self, url="http://localhost:6333", collection="docs", dim=3072):
-        self.client = QdrantClient(url=url, timeout=30)
+    def __init__(self, url="http://localhost:6333", collection="docs", dim=1024, prefer_grpc=True, grpc_port=6334,
+                 quantization=True, pre_normalized=False, client: QdrantClient | None = None,
+                 hnsw_m=16, hnsw_ef_construct=128, hnsw_ef: int | None = None):
+        self.client = client or _shared_client(url, prefer_grpc, grpc_port)
+        self.client_injected = client is not None
+        self.url = url
+        self.prefer_grpc = prefer_grpc
+        self.grpc_port = grpc_port
         self.collection = collection
+        self.dim = dim
+        self.quantization = quantization
+        self.pre_normalized = pre_normalized
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self._ensure_collection()
+
+    def _ensure_collection(self):
         if not self.client.collection_exists(self.collection):
             self.client.create_collection(
                 collection_name=self.collection,
-                vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
+                # Full-precision vectors live on disk; an int8 copy stays in
+                # RAM for scoring and the top hits are rescored in float32.
+                vectors_config=VectorParams(
+                    size=self.dim,
+                    distance=Distance.DOT if self.pre_normalized else Distance.COSINE,
+                    on_disk=True,
+                ),
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(
+                        type=ScalarType.INT8,
+                        quantile=0.99,
+                        always_ram=True,
+                    ),
+                ) if self.quantization else None,
+                hnsw_config=HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct),
+            )
+        # Keyword indexes for every field we filter on, so those filters are
+        # index lookups instead of payload scans. Re-creating an existing
+        # index with the same schema is a no-op on the server.
+        for field_name in INDEXED_FIELDS:
+            self.client.create_payload_index(
+                collection_name=self.collection,
+                field_name=field_name,
+                field_schema=PayloadSchemaType.KEYWORD,
             )
 
-    def upsert(self, ids, vectors, payloads):
-        points = [
-            PointStruct(
-                id=ids[i],
-                vector=vectors[i],
-                payload=payloads[i],
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        # With unit-length vectors a DOT collection ranks exactly like cosine.
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def upsert(self, ids, vectors, payloads, wait: bool = True):
+        if self.pre_normalized:
+            vectors = self._normalize(np.asarray(vectors, dtype=np.float32)).tolist()
+        for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+            end = start + UPSERT_BATCH_SIZE
+            # At most the last request waits; Qdrant applies updates in order,
+            # so once it is acknowledged every earlier batch is visible too.
+            # wait=False skips that final round-trip for fire-and-forget loads.
+            self.client.upsert(
+                collection_name=self.collection,
+                points=Batch(
+                    ids=ids[start:end],
+                    vectors=vectors[start:end],
+                    payloads=payloads[start:end],
+                ),
+                wait=wait and end >= len(ids),
             )
-            for i in range(len(ids))
-        ]
-        self.client.upsert(
+        _search_cache.clear()
+
+    def upsert_bulk(self, ids, vectors, payloads, parallel: int = 4, batch_size: int = UPSERT_BATCH_SIZE):
+        # For large one-off loads: upload_collection splits the points into
+        # batches and serializes/sends them from `parallel` worker processes.
+        vecs = np.asarray(vectors, dtype=np.float32)
+        if self.pre_normalized:
+            vecs = self._normalize(vecs)
+        self.client.upload_collection(
             collection_name=self.collection,
-            points=points,
+            vectors=vecs,
+            payload=payloads,
+            ids=ids,
+            batch_size=batch_size,
+            parallel=parallel,
             wait=True,
         )
+        _search_cache.clear()
 
-    def search(self, query_vector, top_k: int = 5, min_score: float = 0.25, allowed_sources: list[str] | None = None,):
-        if allowed_sources is not None and len(allowed_sources) == 0:
-            return {
-                "contexts": [],
-                "sources": [],
-                "roles": [],
-            }
-
+    def _query_kwargs(self, query_vector, top_k: int, allowed_sources: list[str] | None) -> dict:
         query_filter = None
         if allowed_sources:
-            query_filter = Filter(
-                must=[
-                    FieldCondition(
-                        key="source",
-                        match=MatchAny(any=allowed_sources)
-                    )
-                ]
+            query_filter = _build_source_filter(tuple(sorted(allowed_sources)))
+
+        # hnsw_ef trades recall for search CPU; None keeps the server default.
+        search_params = None
+        if self.quantization or self.hnsw_ef is not None:
+            search_params = SearchParams(
+                hnsw_ef=self.hnsw_ef,
+                quantization=QuantizationSearchParams(
+                    rescore=True,
+                    oversampling=2.0,
+                ) if self.quantization else None,
             )
 
-        res = self.client.query_points(
-            collection_name=self.collection,
-            query=query_vector,
-            with_payload=True,
-            limit=top_k,
-            query_filter=query_filter,
+        # The float32 array feeds normalisation and the search-cache key;
+        # qdrant-client converts it back to a list before sending.
+        query = np.asarray(query_vector, dtype=np.float32)
+        if self.pre_normalized:
+            query = self._normalize(query)
+
+        return {
+            "collection_name": self.collection,
+            "query": query,
+            "with_payload": True,
+            "limit": top_k,
+            "query_filter": query_filter,
+            "search_params": search_params,
+        }
+
+    def _cache_key(self, client, query_kwargs: dict, min_score: float, allowed_sources: list[str] | None) -> tuple:
+        # A digest of the full float32 query, not a lossy signature, so a hit
+        # is always the result the server would have returned. The cache is
+        # shared by every storage, so the key also carries the client (which
+        # server) and the search settings that change the result.
+        digest = hashlib.blake2b(query_kwargs["query"].tobytes(), digest_size=16).digest()
+        sources = tuple(sorted(allowed_sources)) if allowed_sources else None
+        return (
+            id(client), self.collection, self.hnsw_ef, self.quantization,
+            digest, query_kwargs["limit"], min_score, sources,
         )
 
-        contexts = []
-        sources = []
-        roles = set()
+    def search(self, query_vector, top_k: int = 5, min_score: float = 0.25, allowed_sources: list[str] | None = None,):
+        if allowed_sources is not None and len(allowed_sources) == 0:
+            return _empty_result()
 
-        for point in res.points:
-            if point.score is None or point.score < min_score:
-                continue
+        query_kwargs = self._query_kwargs(query_vector, top_k, allowed_sources)
+        key = self._cache_key(self.client, query_kwargs, min_score, allowed_sources)
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
 
-            payload = point.payload or {}
-            text = payload.get("text", "")
-            if not text:
-                continue
+        generation = _search_cache.generation
+        res = self.client.query_points(**query_kwargs)
+        result = _collect_results(res.points, min_score)
+        _search_cache.put(key, result, generation)
+        return result
 
-            contexts.append(text)
-            source = payload.get("source")
-            if source:
-                sources.append({
-                    "document": source,
-                    "section": payload.get("section", ""),
-                    "policy_type": payload.get("policy_type", ""),
-                    "version": payload.get("version", ""),
-                    "jurisdiction": payload.get("jurisdiction", ""),
-                })
-            for r in payload.get("roles", []) or []:
-                roles.add(r)
-
-        if not contexts or not sources:
-            return {
-                "contexts": [],
-                "sources": [],
-                "roles": [],
-            }
-
-        unique_sources = {
-            (s["document"], s["section"], s["version"]): s
-            for s in sources
-        }.values()
+    def vectors_by_chunk_hash(self, hashes: list[str]) -> dict[str, list[float]]:
+        if not hashes:
+            return {}
 
-        return {
-            "contexts": contexts,
-            "sources": list(unique_sources),
-            "roles": sorted(list(roles)),
-        }
+        # One point per hash is enough; boilerplate shared by many documents
+        # would otherwise ship every copy's vector.
+        responses = self.client.query_batch_points(
+            collection_name=self.collection,
+            requests=[
+                QueryRequest(
+                    filter=Filter(
+                        must=[
+                            FieldCondition(
+                                key="chunk_hash",
+                                match=MatchValue(value=h)
+                            )
+                        ]
+                    ),
+                    limit=1,
+                    with_payload=False,
+                    with_vector=True,
+                )
+                for h in hashes
+            ],
+        )
+
+        found = {}
+        for h, res in zip(hashes, responses):
+            if res.points and res.points[0].vector is not None:
+                found[h] = res.points[0].vector
+
+        return found
 
     def list_documents(self, limit: int = 10_000) -> list[dict]:
-        documents = {}
-        offset = None
+        try:
+            hits = self.client.facet(
+                collection_name=self.collection,
+                key="source",
+                limit=limit,
+                exact=True,
+            ).hits
+        except (UnexpectedResponse, grpc.RpcError) as e:
+            # Servers without the facet API (< 1.12) fall back to a full scan;
+            # any other failure (timeouts, 5xx, UNAVAILABLE) is a real error.
+            if not _facet_unsupported(e):
+                raise
+            return self._list_documents_scan()
+
+        if not hits:
+            return []
+
+        # Per-chunk counts come from the facet; the metadata only needs one
+        # point per source, fetched for every source in a single batch call.
+        responses = self.client.query_batch_points(
+            collection_name=self.collection,
+            requests=[
+                QueryRequest(
+                    filter=Filter(
+                        must=[
+                            FieldCondition(
+                                key="source",
+                                match=MatchValue(value=hit.value)
+                            )
+                        ]
+                    ),
+                    limit=1,
+                    with_payload=["policy_type", "version", "jurisdiction"],
+                )
+                for hit in hits
+            ],
+        )
 
+        documents = []
+        for hit, res in zip(hits, responses):
+            payload = (res.points[0].payload if res.points else None) or {}
+            documents.append({
+                "source_id": hit.value,
+                "policy_type": payload.get("policy_type", ""),
+                "version": payload.get("version", ""),
+                "jurisdiction": payload.get("jurisdiction", ""),
+                "chunks": hit.count,
+            })
+
+        return documents
+
+    def _iter_source_payloads(self) -> Iterator[dict]:
+        offset = None
         while True:
             points, offset = self.client.scroll(
                 collection_name=self.collection,
-                with_payload=True,
+                # Only the fields read by the scan; chunk text and vectors
+                # stay on the server.
+                with_payload=["source", "policy_type", "version", "jurisdiction"],
+                with_vectors=False,
                 limit=1000,
                 offset=offset,
             )
-
             for p in points:
-                payload = p.payload or {}
-                source = payload.get("source")
-                if not source:
-                    continue
-
-                if source not in documents:
-                    documents[source] = {
-                        "source_id": source,
-                        "policy_type": payload.get("policy_type", ""),
-                        "version": payload.get("version", ""),
-                        "jurisdiction": payload.get("jurisdiction", ""),
-                        "chunks": 0,
-                    }
-
-                documents[source]["chunks"] += 1
-
+                yield p.payload or {}
             if offset is None:
                 break
 
-        return list(documents.values())
+    def _list_documents_scan(self) -> list[dict]:
+        chunks = Counter()
+        documents = {}
+
+        for payload in self._iter_source_payloads():
+            source = payload.get("source")
+            if not source:
+                continue
+
+            chunks[source] += 1
+            if source not in documents:
+                documents[source] = {
+                    "source_id": source,
+                    "policy_type": payload.get("policy_type", ""),
+                    "version": payload.get("version", ""),
+                    "jurisdiction": payload.get("jurisdiction", ""),
+                }
+
+        return [{**doc, "chunks": chunks[source]} for source, doc in documents.items()]
 
     def delete_document(self, source_id: str) -> int:
+        source_filter = Filter(
+            must=[
+                FieldCondition(
+                    key="source",
+                    match=MatchValue(value=source_id)
+                )
+            ]
+        )
 
-        points, _ = self.client.scroll(
+        deleted = self.client.count(
             collection_name=self.collection,
-            with_payload=False,
-            limit=1,
-            scroll_filter=Filter(
-                must=[
-                    FieldCondition(
-                        key="source",
-                        match=MatchValue(value=source_id)
-                    )
-                ]
-            ),
-        )
+            count_filter=source_filter,
+            exact=True,
+        ).count
 
+        # One filter delete, evaluated when the server applies it: chunks an
+        # in-flight ingest wrote after the count are removed too, and there is
+        # no partial state if a request fails midway.
         self.client.delete(
             collection_name=self.collection,
-            points_selector=Filter(
-                must=[
-                    FieldCondition(
-                        key="source",
-                        match=MatchValue(value=source_id)
-                    )
-                ]
-            ),
+            points_selector=FilterSelector(filter=source_filter),
             wait=True,
         )
+        _search_cache.clear()
+
+        return deleted
+
+
+@functools.lru_cache(maxsize=1)
+def get_storage() -> QdrantStorage:
+    # REST stays available for setups where the gRPC port can't be reached.
+    prefer_grpc = os.getenv("QDRANT_PREFER_GRPC", "1").lower() not in ("0", "false", "no")
+    return QdrantStorage(prefer_grpc=prefer_grpc)
+
+
+class AsyncQdrantStorage:
+    # Async search for the FastAPI/Inngest event loop. Collection setup and
+    # query construction are shared with the wrapped sync storage. If that
+    # storage was given its own client, its url/port settings don't describe
+    # the server, so the matching async client has to be passed in too.
+    def __init__(self, storage: QdrantStorage, client: AsyncQdrantClient | None = None):
+        if client is None and storage.client_injected:
+            raise ValueError("storage uses an injected client; pass the matching AsyncQdrantClient as client")
+        self.storage = storage
+        self.client = client or AsyncQdrantClient(
+            url=storage.url,
+            prefer_grpc=storage.prefer_grpc,
+            grpc_port=storage.grpc_port,
+            timeout=30,
+        )
+
+    async def search(self, query_vector, top_k: int = 5, min_score: float = 0.25, allowed_sources: list[str] | None = None,):
+        if allowed_sources is not None and len(allowed_sources) == 0:
+            return _empty_result()
+
+        query_kwargs = self.storage._query_kwargs(query_vector, top_k, allowed_sources)
+        key = self.storage._cache_key(self.client, query_kwargs, min_score, allowed_sources)
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
+
+        generation = _search_cache.generation
+        res = await self.client.query_points(**query_kwargs)
+        result = _collect_results(res.points, min_score)
+        _search_cache.put(key, result, generation)
+        return result
+
+
+_async_storage: AsyncQdrantStorage | None = None
+
 
-        return len(points)
+async def get_async_storage() -> AsyncQdrantStorage:
+    global _async_storage
+    if _async_storage is None:
+        # get_storage() does blocking collection setup RPCs on first use;
+        # keep them off the event loop.
+        storage = await asyncio.to_thread(get_storage)
+        if _async_storage is None:
+            _async_storage = AsyncQdrantStorage(storage)
+    return _async_storage